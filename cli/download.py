@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import datetime
 import os
 
@@ -12,8 +13,8 @@ import pdb
 ### Command line interface for downloading Sentinel-2 data ###
 ##############################################################
 
-def main(username, password, tiles, level = '1C', start = '20150523', end = datetime.datetime.today().strftime('%Y%m%d'), maxcloud = 100, minsize = 25., output_dir = os.getcwd(), remove = False):
-    """main(username, password, tiles, level = '1C', start = '20150523', end = datetime.datetime.today().strftime('%Y%m%d'), maxcloud = 100, minsize = 25., output_dir = os.getcwd(), remove = False)
+def main(username, password, tiles, level = '1C', start = '20150523', end = None, maxcloud = 100, minsize = 25., output_dir = os.getcwd(), remove = False, background_decompress = False):
+    """main(username, password, tiles, level = '1C', start = '20150523', end = None, maxcloud = 100, minsize = 25., output_dir = os.getcwd(), remove = False, background_decompress = False)
     
     Download Sentinel-2 data from the Copernicus Open Access Hub, specifying a particular tile, date ranges and degrees of cloud cover. This is the function that is initiated from the command line.
     
@@ -28,28 +29,52 @@ def main(username, password, tiles, level = '1C', start = '20150523', end = date
         minsize: A float with the minimum filesize to download in MB. Defaults to 25 MB.  Be aware, file sizes smaller than this can result sen2three crashing.
         output_dir: Optionally specify an output directory. Defaults to the present working directory.
         remove: Boolean value, which when set to True deletes level 1C .zip files after decompression is complete. Defaults to False.
+        background_decompress: Set True to decompress each tile's files in a background thread while the next tile is downloaded. Defaults to False.
     """
     
     # Allow download of single tile
     if type(tiles) == str: tiles = [tiles]
     
-    for tile in tiles:
-                
-        # Connect to API (or reconnect, after timeout)
-        sen2mosaic.download.connectToAPI(username, password)
+    # A single worker keeps decompression ordered, and overlaps it with network transfers
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1) if background_decompress else None
+    decompressions = []
     
-        # Search for files, return a data frame containing details of matching Sentinel-2 images
-        products = sen2mosaic.download.search(tile, level = level, start = start, end = end, maxcloud = maxcloud, minsize = minsize)
+    try:
         
-        # Where no data
-        if len(products) == 0: continue
+        for tile in tiles:
+                
+            # Connect to API (or reconnect, after timeout)
+            sen2mosaic.download.connectToAPI(username, password)
+    
+            # Search for files, return a data frame containing details of matching Sentinel-2 images
+            products = sen2mosaic.download.search(tile, level = level, start = start, end = end, maxcloud = maxcloud, minsize = minsize)
         
-        # Download products
-        zip_files = sen2mosaic.download.download(products, output_dir = output_dir)
+            # Where no data
+            if len(products) == 0: continue
         
-        # Decompress data
-        sen2mosaic.download.decompress(zip_files, output_dir = output_dir, remove = remove)
+            # Download products
+            zip_files = sen2mosaic.download.download(products, output_dir = output_dir)
         
+            # Decompress data
+            if background_decompress:
+                decompressions.append(executor.submit(sen2mosaic.download.decompress, zip_files, output_dir = output_dir, remove = remove))
+            else:
+                sen2mosaic.download.decompress(zip_files, output_dir = output_dir, remove = remove)
+    
+    except Exception:
+        # Where a search or download fails, wait for outstanding decompression and report its errors, which would otherwise be lost
+        if background_decompress:
+            executor.shutdown()
+            for decompression in decompressions:
+                if decompression.exception() is not None:
+                    print("WARNING: Decompression failed with error '%s'."%str(decompression.exception()))
+        raise
+    
+    # Wait for outstanding decompression, raising any errors
+    if background_decompress:
+        executor.shutdown()
+        for decompression in decompressions:
+            decompression.result()
 
 
 if __name__ == '__main__':
@@ -71,14 +96,15 @@ if __name__ == '__main__':
     # Optional arguments
     optional.add_argument('-l', '--level', type = str, default = '1C', help = "Set to search and download level '1C' (default) or '2A' data. Note that L2A data may not be available at all locations.")
     optional.add_argument('-s', '--start', type = str, default = '20150523', help = "Start date for search in format YYYYMMDD. Defaults to 20150523.")
-    optional.add_argument('-e', '--end', type = str, default = datetime.datetime.today().strftime('%Y%m%d'), help = "End date for search in format YYYYMMDD. Defaults to today's date.")
+    optional.add_argument('-e', '--end', type = str, default = None, help = "End date for search in format YYYYMMDD. Defaults to today's date.")
     optional.add_argument('-c', '--cloud', type = int, default = 100, metavar = '%', help = "Maximum percentage of cloud cover to download. Defaults to 100 %% (download all images, regardless of cloud cover).")
     optional.add_argument('-m', '--minsize', type = int, default = 25., metavar = 'MB', help = "Minimum file size to download in MB. Defaults to 25 MB.")
     optional.add_argument('-o', '--output_dir', type = str, metavar = 'PATH', default = os.getcwd(), help = "Specify an output directory. Defaults to the present working directory.")
     optional.add_argument('-r', '--remove', action='store_true', default = False, help = "Remove level 1C .zip files after decompression.")
+    optional.add_argument('-b', '--background', action='store_true', default = False, help = "Decompress downloaded files in the background while downloading the next tile.")
         
     # Get arguments from command line
     args = parser.parse_args()
     
     # Run through entire processing sequence
-    main(args.user, args.password, args.tiles, level = args.level, start = args.start, end = args.end, maxcloud = args.cloud, minsize = args.minsize, output_dir = args.output_dir, remove = args.remove)
+    main(args.user, args.password, args.tiles, level = args.level, start = args.start, end = args.end, maxcloud = args.cloud, minsize = args.minsize, output_dir = args.output_dir, remove = args.remove, background_decompress = args.background)
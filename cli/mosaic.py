@@ -2,12 +2,14 @@
 
 import argparse
 import datetime
+import functools
 import numpy as np
 import os
 
 import sen2mosaic.core
 import sen2mosaic.IO
 import sen2mosaic.mosaic
+import sen2mosaic.multiprocess
 
 import pdb
 
@@ -44,9 +46,31 @@ def _getBands(resolution):
     return np.array(res_list), np.array(band_list)
 
 
+def _buildBand(band, source_files, md_dest, mask_band = None, verbose = False, **kwargs):
+    '''
+    Build a composite image for a single band. Wrapper for buildComposite() to enable bands to be processed in parallel.
+    
+    Args:
+        band: Sentinel-2 band name (e.g. 'B02')
+        source_files: A list of level 1C/2A Sentinel-2 input files.
+        md_dest: Metadata object of output image.
+        mask_band: Name of the band to output the SLC mask alongside. Defaults to no mask output.
+        verbose: Make script verbose (set True).
+        **kwargs: Further arguments to buildComposite().
+    Returns:
+        True, once the band has been built.
+    '''
+    
+    if verbose: print('Building band %s at %s m resolution'%(band, str(md_dest.res)))
+    
+    sen2mosaic.mosaic.buildComposite(source_files, band, md_dest, output_mask = band == mask_band, return_mask = False, verbose = verbose, **kwargs)
+    
+    return True
+
 
-def main(source_files, extent_dest, EPSG_dest, resolution = 0, percentile = 25., level = '1C', start = '20150101', end = datetime.datetime.today().strftime('%Y%m%d'), improve_mask = False, colour_balance = False, processes = 1, output_dir = os.getcwd(), output_name = 'mosaic', masked_vals = 'auto', temp_dir = '/tmp', verbose = False):
-    """main(source_files, extent_dest, EPSG_dest, start = '20150101', end = datetime.datetime.today().strftime('%Y%m%d'), resolution = 0, improve_mask = False, colour_balance = False, processes = 1, output_dir = os.getcwd(), output_name = 'mosaic', masked_vals = 'auto', temp_dir = '/tmp', verbose = False)
+
+def main(source_files, extent_dest, EPSG_dest, resolution = 0, percentile = 25., level = '1C', start = '20150101', end = None, improve_mask = False, colour_balance = False, processes = 1, output_dir = os.getcwd(), output_name = 'mosaic', masked_vals = 'auto', temp_dir = '/tmp', step = 2000, compress = 'LZW', verbose = False):
+    """main(source_files, extent_dest, EPSG_dest, start = '20150101', end = None, resolution = 0, improve_mask = False, colour_balance = False, processes = 1, output_dir = os.getcwd(), output_name = 'mosaic', masked_vals = 'auto', temp_dir = '/tmp', step = 2000, compress = 'LZW', verbose = False)
     
     Function to generate seamless mosaics from a list of Sentinel-2 level-2A input files.
         
@@ -60,11 +84,13 @@ def main(source_files, extent_dest, EPSG_dest, resolution = 0, percentile = 25.,
         start: Start date to process, in format 'YYYYMMDD' Defaults to start of Sentinel-2 era.
         end: End date to process, in format 'YYYYMMDD' Defaults to today's date.
         improve_mask: Set True to apply improvements Sentinel-2 cloud mask. Not generally recommended.
-        processes: Number of processes to run similtaneously. Defaults to 1.
+        processes: Number of processes to run similtaneously. Bands are processed in parallel, with any further processes used to composite blocks of each band. Defaults to 1.
         output_dir: Optionally specify an output directory.
         output_name: Optionally specify a string to precede output file names. Defaults to 'mosaic'.
         masked_vals: List of SLC mask values to not include in the final mosaic. Defaults to 'auto', which masks everything except [4,5,6]
         temp_dir: Directory to temporarily write L1C mask files. Defaults to /tmp
+        step: Size of square blocks (in pixels) in which each tile is composited. Smaller blocks use less memory. Must be an even number. Defaults to 2000.
+        compress: GeoTiff compression algorithm for output files, 'LZW' (default), 'DEFLATE' or 'ZSTD'.
         verbose: Make script verbose (set True).
     """
     
@@ -77,18 +103,29 @@ def main(source_files, extent_dest, EPSG_dest, resolution = 0, percentile = 25.,
         # Build metadata of output object
         md_dest = sen2mosaic.core.Metadata(extent_dest, res, EPSG_dest)
         
-        # Only output one mask layer
-        output_mask = True
-        for band in band_list[res_list==res]:
-            
-            if verbose: print('Building band %s at %s m resolution'%(band, str(res)))
-            
-            # Build composite image for list of input scenes
-            band_out, QA_out = sen2mosaic.mosaic.buildComposite(source_files, band, md_dest, level = level, resolution = resolution, output_dir = output_dir, output_name = output_name, start = start, end = end, colour_balance = colour_balance, improve_mask = improve_mask, percentile = 25., processes = processes, step = 2000, masked_vals = masked_vals, temp_dir = temp_dir, verbose = verbose, output_mask = output_mask)            
-            
-            # Only output mask on first iteration
-            output_mask = False
+        bands = band_list[res_list==res]
+        
+        # Load and sort scenes once for all bands at this resolution
+        scenes = sen2mosaic.IO.loadSceneList(source_files, resolution = res, md_dest = md_dest, start = start, end = end, level = level, sort_by = 'date')
+        
+        # Each band is independent, so process multiple bands similtaneously. Where there are more processes than bands, share the remainder out to composite blocks within each band.
+        band_processes = min(processes, len(bands))
+        block_processes = max(processes // band_processes, 1)
+        
+        # Build composite image for list of input scenes. Only output one mask layer, alongside the first band.
+        build_partial = functools.partial(_buildBand, source_files = source_files, md_dest = md_dest, mask_band = bands[0], scenes = scenes, level = level, resolution = res, output_dir = output_dir, output_name = output_name, start = start, end = end, colour_balance = colour_balance, improve_mask = improve_mask, percentile = percentile, processes = block_processes, step = step, masked_vals = masked_vals, temp_dir = temp_dir, compress = compress, verbose = verbose)
+        
+        if band_processes == 1:
+            for band in bands:
+                build_partial(band)
+        else:
+            completion = sen2mosaic.multiprocess.runWorkers(build_partial, band_processes, list(bands))
             
+            # Failed bands are only reported by runWorkers(), so stop before building visualisation files over missing outputs
+            failed = [band for band, c in zip(bands, completion) if c != True]
+            if len(failed) > 0:
+                raise IOError("Failed to build band(s) %s at %s m resolution. See warnings above for details."%(', '.join(failed), str(res)))
+        
         # Build VRT output files for straightforward visualisation
         if verbose: print('Building .VRT images for visualisation')
         
@@ -126,15 +163,17 @@ if __name__ == "__main__":
     # Optional arguments
     optional.add_argument('-l', '--level', type=str, metavar='1C/2A', default = '2A', help = "Input image processing level, '1C' or '2A'. Defaults to '2A'.")
     optional.add_argument('-st', '--start', type = str, default = '20150101', help = "Start date for tiles to include in format YYYYMMDD. Defaults to processing all dates.")
-    optional.add_argument('-en', '--end', type = str, default = datetime.datetime.today().strftime('%Y%m%d'), help = "End date for tiles to include in format YYYYMMDD. Defaults to processing all dates.")
+    optional.add_argument('-en', '--end', type = str, default = None, help = "End date for tiles to include in format YYYYMMDD. Defaults to processing all dates.")
     optional.add_argument('-pc', '--percentile', metavar = 'PC', type=float, default = 25., help="Specify a percentile of reflectance to output. Defaults to 25 percent, which tends to produce good results.")
     optional.add_argument('-m', '--masked_vals', metavar = 'N', type=str, nargs='*', default = ['auto'], help="Specify SLC values to not include in the mosaic (e.g. -m 7 8 9). See http://step.esa.int/main/third-party-plugins-2/sen2cor/ for description of sen2cor mask values. Defaults to 'auto', which masks values 0 and 9. Also accepts 'none', to include all values.")
     optional.add_argument('-b', '--colour_balance', action='store_true', default = False, help = "Perform colour balancing between tiles. Not generally recommended, particularly where working over large areas. Defaults to False.")
     optional.add_argument('-i', '--improve_mask', action='store_true', default = False, help = "Apply improvements to Sentinel-2 cloud mask. Not generally recommended, except where a very conservative mask is desired. Defaults to no improvement.")
     optional.add_argument('-t', '--temp_dir', type=str, metavar = 'DIR', default = '/tmp', help="Directory to write temporary files, only required for L1C data. Defaults to '/tmp'.")
     optional.add_argument('-o', '--output_dir', type=str, metavar = 'DIR', default = os.getcwd(), help="Specify an output directory. Defaults to the present working directory.")
+    optional.add_argument('-bs', '--block_size', type = int, metavar = 'PX', default = 2000, help = "Size of square blocks (in pixels) in which each Sentinel-2 tile is composited. Smaller blocks reduce memory use, larger blocks reduce the number of image reads. Must be an even number. Defaults to 2000.")
+    optional.add_argument('-z', '--compress', type=str, metavar = 'ALG', default = 'LZW', choices = ['LZW', 'DEFLATE', 'ZSTD'], help="Compression algorithm for output GeoTiffs, 'LZW', 'DEFLATE' or 'ZSTD'. ZSTD is fastest and produces the smallest files, but requires GDAL 2.3 or later. Defaults to 'LZW'.")
     optional.add_argument('-n', '--output_name', type=str, metavar = 'NAME', default = 'mosaic', help="Specify a string to precede output filename. Defaults to 'mosaic'.")
-    optional.add_argument('-p', '--n_processes', type = int, metavar = 'N', default = 1, help = "Specify a maximum number of tiles to process in paralell. Bear in mind that more processes will require more memory. Defaults to 1.")
+    optional.add_argument('-p', '--n_processes', type = int, metavar = 'N', default = 1, help = "Specify a maximum number of processes to run in paralell. Bands are processed in parallel, with any further processes used to composite blocks within each band. Bear in mind that more processes will require more memory. Defaults to 1.")
     optional.add_argument('-v', '--verbose', action='store_true', default = False, help = "Make script verbose.")
     
     # Get arguments
@@ -152,6 +191,6 @@ if __name__ == "__main__":
     # Find all matching granule files
     #infiles = sen2mosaic.IO.prepInfiles(infiles, args.level)
     
-    main(infiles, args.target_extent, args.epsg, resolution = args.resolution, percentile = args.percentile, level = args.level, start = args.start, end = args.end, improve_mask = args.improve_mask, colour_balance = args.colour_balance, processes = args.n_processes, output_dir = args.output_dir, output_name = args.output_name, masked_vals = masked_vals, temp_dir = args.temp_dir, verbose = args.verbose)
+    main(infiles, args.target_extent, args.epsg, resolution = args.resolution, percentile = args.percentile, level = args.level, start = args.start, end = args.end, improve_mask = args.improve_mask, colour_balance = args.colour_balance, processes = args.n_processes, output_dir = args.output_dir, output_name = args.output_name, masked_vals = masked_vals, temp_dir = args.temp_dir, step = args.block_size, compress = args.compress, verbose = args.verbose)
     
     
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
 import argparse
+import fnmatch
 import functools
+import glob
 import numpy as np
 import os
 
 import sen2mosaic.core
+import sen2mosaic.IO
 import sen2mosaic.multiprocess
 import sen2mosaic.preprocess
 
@@ -23,6 +26,8 @@ def main(infile, gipp = None, output_dir = os.getcwd(), resolution = 0, sen2cor
         infile: A Level 1C Sentinel-2 .SAFE file.
         gipp: Optionally specify a copy of the L2A_GIPP.xml file in order to tweak options.
         output_dir: Optionally specify an output directory. The option gipp must also be specified if you use this option.
+    Returns:
+        A boolean describing whether processing completed sucessfully.
     """
     
     assert resolution in [0, 10, 20, 60], "Resolution must be set to 0, 10, 20 or 60 m."
@@ -34,20 +39,28 @@ def main(infile, gipp = None, output_dir = os.getcwd(), resolution = 0, sen2cor
     try:
         
         # Loop through all resolutions if set to 0
-        for resolution in resolutions:
+        for res in resolutions:
             
-            S2_scene = sen2mosaic.core.LoadScene(infile, resolution = resolution)
+            S2_scene = sen2mosaic.core.LoadScene(infile, resolution = res)
             
-            L2A_file = S2_scene.processToL2A(gipp = gipp, output_dir = output_dir, resolution = resolution, sen2cor = sen2cor, sen2cor_255 = sen2cor_255, verbose = verbose)
+            L2A_file = S2_scene.processToL2A(gipp = gipp, output_dir = output_dir, resolution = res, sen2cor = sen2cor, sen2cor_255 = sen2cor_255, verbose = verbose)
     
     except Exception as e:
         raise
+    
+    finally:
+        # New level 2A files may have been written, so make sure they're found by any later search of output_dir
+        sen2mosaic.IO.clearPrepCache()
                 
     # Test for completion, and report back
-    if sen2mosaic.preprocess.testCompletion(infile, output_dir = output_dir, resolution = resolution) == False:   
+    completion = sen2mosaic.preprocess.testCompletion(infile, output_dir = output_dir, resolution = resolution)
+    
+    if completion == False:   
         
         print('WARNING: %s did not complete processing at %s m resolution.'%(infile, str(resolution)))
     
+    return completion
+    
 
 if __name__ == '__main__':
     '''
@@ -83,11 +96,17 @@ if __name__ == '__main__':
     # Get absolute path for output directory
     args.output_dir = os.path.abspath(args.output_dir)
     
-    # Strip the output files already exist.
+    # Warn where output files already exist, as these will be skipped. Output paths contain wildcards, so list the output directory once and match .SAFE files against it.
+    existing_SAFE = os.listdir(args.output_dir) if os.path.isdir(args.output_dir) else []
+    
     for infile in infiles[:]:
+        outpath_SAFE = sen2mosaic.preprocess.getL2AFilename(infile, output_dir = args.output_dir, SAFE = True)
+        
+        if len(fnmatch.filter(existing_SAFE, os.path.basename(outpath_SAFE))) == 0: continue
+        
         outpath = sen2mosaic.preprocess.getL2AFilename(infile, output_dir = args.output_dir)
         
-        if os.path.exists(outpath):
+        if len(glob.glob(outpath)) > 0:
             print('WARNING: The output file %s already exists! Skipping file.'%outpath)
     
     if len(infiles) == 0: raise ValueError('No level 1C Sentinel-2 files detected in input directory that match specification.')
@@ -95,19 +114,20 @@ if __name__ == '__main__':
     if args.n_processes == 1:
         
         # Keep things simple when using one processor
+        completion = []
         for infile in infiles:
             
-            main(infile, gipp = args.gipp, output_dir = args.output_dir, resolution = args.resolution, sen2cor = args.sen2cor, sen2cor_255 = args.sen2cor255, verbose = args.verbose) 
+            completion.append(main(infile, gipp = args.gipp, output_dir = args.output_dir, resolution = args.resolution, sen2cor = args.sen2cor, sen2cor_255 = args.sen2cor255, verbose = args.verbose))
     
     else:
 
         # Set up function with multiple arguments, and run in parallel
         main_partial = functools.partial(main, gipp = args.gipp, output_dir = args.output_dir, resolution = args.resolution, sen2cor = args.sen2cor, sen2cor_255 = args.sen2cor255, verbose = args.verbose)
     
-        sen2mosaic.multiprocess.runWorkers(main_partial, args.n_processes, infiles)
+        completion = sen2mosaic.multiprocess.runWorkers(main_partial, args.n_processes, infiles)
     
-    # Test for completion
-    completion = np.array([sen2mosaic.preprocess.testCompletion(infile, output_dir = args.output_dir, resolution = args.resolution) for infile in infiles])
+    # Completion was tested as each file was processed. Files where processing failed outright are incomplete.
+    completion = np.array([c == True for c in completion])
     
     # Report back
     if completion.sum() > 0: print('Successfully processed files:')
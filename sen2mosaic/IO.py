@@ -1,10 +1,12 @@
 
 
+import concurrent.futures
 import datetime
+import functools
 import glob
 import numpy as np
 import os
-from osgeo import gdal, gdalnumeric, osr, ogr
+from osgeo import gdal, gdal_array, gdalnumeric, osr, ogr
 from PIL import Image, ImageDraw
 import re
 import shapefile
@@ -32,54 +34,68 @@ def _reprojectImage(ds_source, ds_dest, md_source, md_dest, resampling = 0):
         md_dest: Metadata class from sen2mosaic.Metadata() representing the destination image.
     
     Returns:
-        A GDAL array with resampled data
+        A GDAL array with resampled data. Where ds_dest has multiple bands, the array has the shape (bands, rows, cols).
     '''
     
     from osgeo import gdal
     
-    def _copyds(ds):
-        '''
-        Build a copy of an input ds, where performing fix on nodata values
-        '''
+    proj_source = md_source.wkt
+    proj_dest = md_dest.wkt
+    
+    # Reproject source into dest project coordinates, using all available cores. A larger working buffer than GDAL's default (64 MB) means whole tiles are warped in a few large chunks.
+    # Coordinates are interpolated between exactly transformed points to within 1/8 of a pixel (as gdalwarp does by default), rather than transforming every pixel.
+    gdal.Warp(ds_dest, ds_source, options = gdal.WarpOptions(srcSRS = proj_source, dstSRS = proj_dest, resampleAlg = resampling, errorThreshold = 0.125, multithread = True, warpMemoryLimit = 1024 * 1024 * 1024, warpOptions = ['NUM_THREADS=ALL_CPUS']))
+            
+    ds_resampled = ds_dest.ReadAsArray()
+    
+    return np.squeeze(ds_resampled)
+
+
+
+def _resampleNearest(data, md_source, md_dest, dtype = 2):
+    '''
+    Resamples an array to a destination grid in the same coordinate reference system with nearest neighbour resampling. Selects pixels as GDAL's nearest neighbour kernel does, so matches _reprojectImage() up to floating point differences in the transformation, but as it is separable, source pixels are selected by row and column rather than warped. Where the grids are also aligned at the same resolution, the overlapping window is copied.
+    
+    Args:
+        data: A numpy array of data with the extent of md_source, optionally with multiple layers on the third axis.
+        md_source: Metadata class from sen2mosaic.Metadata() representing the source image.
+        md_dest: Metadata class from sen2mosaic.Metadata() representing the destination image, with the same EPSG code as md_source.
+        dtype: GDAL data type of output.
+    
+    Returns:
+        A numpy array with resampled data
+    '''
+    
+    data_resampled = np.zeros((md_dest.nrows, md_dest.ncols) + data.shape[2:], dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dtype))
+    
+    # Offset of the destination grid from the source grid, in source pixels
+    col_off = (md_dest.ulx - md_source.ulx) / md_source.xres
+    row_off = (md_dest.uly - md_source.uly) / md_source.yres
+    
+    # Where pixels are the same size and grids are aligned, the overlapping window is copied directly
+    if md_dest.xres == md_source.xres and md_dest.yres == md_source.yres and abs(col_off - round(col_off)) < 1e-6 and abs(row_off - round(row_off)) < 1e-6:
         
-        proj = osr.SpatialReference(wkt=ds.GetProjection())
-        proj.AutoIdentifyEPSG()
-        epsg = int(proj.GetAttrValue('AUTHORITY',1))
-                
-        geo_t = ds.GetGeoTransform()
-        ulx = geo_t[0]
-        lrx = geo_t[0] + (geo_t[1] * ds.RasterXSize)
-        lry = geo_t[3] + (geo_t[5] * ds.RasterYSize)
-        uly = geo_t[3]
+        col_off, row_off = int(round(col_off)), int(round(row_off))
         
-        extent = [ulx, lry, lrx, uly]
-                
-        md = sen2mosaic.core.Metadata(extent, ds.GetGeoTransform()[1], epsg)
-        return createGdalDataset(md, dtype = 1)
+        col_start, col_end = max(col_off, 0), min(col_off + md_dest.ncols, md_source.ncols)
+        row_start, row_end = max(row_off, 0), min(row_off + md_dest.nrows, md_source.nrows)
+        
+        if col_end > col_start and row_end > row_start:
+            data_resampled[row_start-row_off:row_end-row_off, col_start-col_off:col_end-col_off] = data[row_start:row_end, col_start:col_end]
+        
+        return data_resampled
     
-    proj_source = md_source.proj.ExportToWkt()
-    proj_dest = md_dest.proj.ExportToWkt()
+    # Otherwise, locate the source column and row of each destination pixel centre. As GDAL, a small offset is added so that centres falling on a source pixel edge consistently select the pixel after it.
+    cols = np.floor((md_dest.ulx + (np.arange(md_dest.ncols) + 0.5) * md_dest.xres - md_source.ulx) / md_source.xres + 1e-10).astype(np.int64)
+    rows = np.floor((md_dest.uly + (np.arange(md_dest.nrows) + 0.5) * md_dest.yres - md_source.uly) / md_source.yres + 1e-10).astype(np.int64)
     
-    # Reproject source into dest project coordinates
-    gdal.ReprojectImage(ds_source, ds_dest, proj_source, proj_dest, resampling)
-            
-    ds_resampled = ds_dest.GetRasterBand(1).ReadAsArray()
+    # Destination pixels outside of the source image are set to 0
+    valid_cols = (cols >= 0) & (cols < md_source.ncols)
+    valid_rows = (rows >= 0) & (rows < md_source.nrows)
     
-    """
-    # This may be required again, but for now leave this out, memory requirement is unpredictable.
-    
-    # As GDAL fills in all nodata pixels as zero, re-do transfromation with array of ones and re-allocate zeros to nodata. Only run where a nodata value has been assigned to ds_source.
-    if ds_source.GetRasterBand(1).GetNoDataValue() is not None:
-        ds_source_mask = _copyds(ds_source)
-        ds_dest_mask = _copyds(ds_dest)
-        #ds_source_mask.GetRasterBand(1).WriteArray(np.ones_like(ds_source.GetRasterBand(1).ReadAsArray()))
-        ds_source_mask.GetRasterBand(1).WriteArray(np.ones((ds_source.RasterYSize, ds_source.RasterXSize), dtype = np.bool))
-        gdal.ReprojectImage(ds_source_mask, ds_dest_mask, proj_source, proj_dest, gdal.GRA_NearestNeighbour)
-        ds_resampled[ds_dest_mask.GetRasterBand(1).ReadAsArray() == 0] = ds_source.GetRasterBand(1).GetNoDataValue()
-    """
+    data_resampled[np.ix_(valid_rows, valid_cols)] = data[np.ix_(rows[valid_rows], cols[valid_cols])]
     
-    return np.squeeze(ds_resampled)
-
+    return data_resampled
 
 
 def createGdalDataset(md, data_out = None, filename = '', driver = 'MEM', dtype = 3, RasterCount = 1, nodata = None, options = []):
@@ -97,16 +113,13 @@ def createGdalDataset(md, data_out = None, filename = '', driver = 'MEM', dtype
     Returns:
         A GDAL dataset.
     '''
-    from osgeo import gdal, osr
+    from osgeo import gdal
         
     gdal_driver = gdal.GetDriverByName(driver)
     ds = gdal_driver.Create(filename, md.ncols, md.nrows, RasterCount, dtype, options = options)
     
     ds.SetGeoTransform(md.geo_t)
-    
-    proj = osr.SpatialReference()
-    proj.ImportFromEPSG(md.EPSG_code)
-    ds.SetProjection(proj.ExportToWkt())
+    ds.SetProjection(md.wkt)
     
     # If a data array specified, add data to the gdal dataset
     if type(data_out).__module__ == np.__name__:
@@ -115,10 +128,20 @@ def createGdalDataset(md, data_out = None, filename = '', driver = 'MEM', dtype
             data_out = np.ma.expand_dims(data_out,2)
         
         for feature in range(RasterCount):
-            ds.GetRasterBand(feature + 1).WriteArray(data_out[:,:,feature])
+            
+            band = ds.GetRasterBand(feature + 1)
+            
+            if driver == 'MEM':
+                band.WriteArray(data_out[:,:,feature])
+            
+            # When writing to disk, write strips of whole blocks so that each can be compressed and flushed before the next
+            else:
+                block_rows = band.GetBlockSize()[1] * max(1, 512 // band.GetBlockSize()[1])
+                for row in range(0, md.nrows, block_rows):
+                    band.WriteArray(data_out[row:row+block_rows,:,feature], 0, row)
             
             if nodata != None:
-                ds.GetRasterBand(feature + 1).SetNoDataValue(nodata)
+                band.SetNoDataValue(nodata)
     
     # If a filename is specified, write the array to disk.
     if filename != '':
@@ -134,22 +157,37 @@ def reprojectBand(scene, data, md_dest, dtype = 2, resampling = 0):
     
     Args:
         scene: A level-2A scene of class sen2mosaic.LoadScene().
-        data: The array to reproject
+        data: The array to reproject. To reproject several arrays with the same geometry in a single pass, stack them on the third axis.
         md_dest: An object of class sen2mosaic.Metadata() to reproject image to.
+        dtype: GDAL data type of output. Where data already has this type, it is read in place rather than copied.
     
     Returns:
         A numpy array of resampled mask data
     """
     
-    # Write mask array to a gdal dataset
-    ds_source = createGdalDataset(scene.metadata, data_out = data, dtype = dtype)
+    # Nearest neighbour resampling within a coordinate reference system doesn't need a warp
+    if resampling == 0 and scene.metadata.EPSG_code == md_dest.EPSG_code:
+        return _resampleNearest(data, scene.metadata, md_dest, dtype = dtype)
+    
+    # Where the array is already of the output data type, wrap it as a gdal dataset without copying
+    if data.ndim == 2 and gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype.type) == dtype:
+        ds_source = gdal_array.OpenArray(data)
+        ds_source.SetGeoTransform(scene.metadata.geo_t)
+        ds_source.SetProjection(scene.metadata.wkt)
+    
+    # Otherwise write array to a gdal dataset
+    else:
+        ds_source = createGdalDataset(scene.metadata, data_out = data, dtype = dtype, RasterCount = 1 if data.ndim == 2 else data.shape[2])
         
     # Create an empty gdal dataset for destination
-    ds_dest = createGdalDataset(md_dest, dtype = dtype)
+    ds_dest = createGdalDataset(md_dest, dtype = dtype, RasterCount = ds_source.RasterCount)
     
     # Reproject source to destination projection and extent
     data_resampled = _reprojectImage(ds_source, ds_dest, scene.metadata, md_dest, resampling = resampling)
     
+    # Return layers on the third axis, as input
+    if data.ndim == 3: data_resampled = np.moveaxis(data_resampled.reshape((-1, md_dest.nrows, md_dest.ncols)), 0, -1)
+    
     return data_resampled
 
 
@@ -593,6 +631,77 @@ def loadMetadata(granule_file, resolution = 20, level = '2A', tile = ''):
 ### Sentinel-2 input files ###
 ##############################
 
+# Format of a Sentinel-2 tile name (e.g. '36KWA')
+_TILE_RE = re.compile(r'[0-9]{2}[A-Z]{3}$')
+
+
+@functools.lru_cache(maxsize = 64)
+def _listGranuleNames(directory, level, mtime):
+    """
+    Lists granules of all Sentinel-2 .SAFE files of a processing level in a directory, as (.SAFE name, granule name) pairs. Internal function for _listGranules().
+    
+    Results are cached on the absolute path and modification time of directory. Use clearPrepCache() where granules may have been added to an existing .SAFE file since.
+    
+    Args:
+        directory: An absolute path to a directory containing Sentinel-2 .SAFE files.
+        level: Set to either '1C' or '2A' to select appropriate granules.
+        mtime: Modification time of directory, so that the cache is refreshed when .SAFE files are added or removed.
+    Returns:
+        A tuple of (.SAFE name, granule name) pairs.
+    """
+    
+    granules = []
+    
+    # As glob, a directory that can't be read contributes nothing
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return tuple(granules)
+    
+    for entry in entries:
+        
+        if '_MSIL%s_'%level not in entry.name or entry.name.startswith('.'): continue
+        
+        try:
+            granules.extend([(entry.name, granule.name) for granule in os.scandir('%s/GRANULE'%entry.path) if not granule.name.startswith('.')])
+        except OSError:
+            pass
+    
+    return tuple(granules)
+
+
+def _listGranules(directory, level):
+    """
+    Lists granules of all Sentinel-2 .SAFE files of a processing level in a directory. Equivalent to glob.glob('directory/*_MSIL<level>_*/GRANULE/*'), but lists each directory once without pattern matching.
+    
+    Listings are cached, as the same directory is typically searched once per resolution. The cache is keyed on the absolute path and modification time of directory, so remains correct where the working directory changes or .SAFE files are added, but paths are returned relative to directory as given.
+    
+    Args:
+        directory: A directory containing Sentinel-2 .SAFE files.
+        level: Set to either '1C' or '2A' to select appropriate granules.
+    Returns:
+        A list of granules.
+    """
+    
+    directory_abs = os.path.abspath(directory)
+    
+    # As glob, a directory that can't be read contributes nothing
+    try:
+        mtime = os.stat(directory_abs).st_mtime_ns
+    except OSError:
+        return []
+    
+    return ['%s/GRANULE/%s'%(os.path.join(directory, safe), granule) for safe, granule in _listGranuleNames(directory_abs, level, mtime)]
+
+
+def clearPrepCache():
+    """
+    Clear directory listings cached by prepInfiles(), so that files written since are found.
+    """
+    
+    _listGranuleNames.cache_clear()
+
+
 def prepInfiles(infiles, level, tile = ''):
     """
     Function to select input granules from a directory, .SAFE file (with wildcards) or granule, based on processing level and a tile. Used by command line interface to identify input files.
@@ -606,7 +715,7 @@ def prepInfiles(infiles, level, tile = ''):
     """
     
     assert level in ['1C', '2A'], "Sentinel-2 processing level must be either '1C' or '2A'."
-    assert bool(re.match("[0-9]{2}[A-Z]{3}$",tile)) or tile == '', "Tile format not recognised. It should take the format '##XXX' (e.g. '36KWA')."
+    assert bool(_TILE_RE.match(tile)) or tile == '', "Tile format not recognised. It should take the format '##XXX' (e.g. '36KWA')."
     
     # Make interable if only one item
     if not isinstance(infiles, list):
@@ -615,10 +724,13 @@ def prepInfiles(infiles, level, tile = ''):
     # Get absolute path, stripped of symbolic links
     #infiles = [os.path.abspath(os.path.realpath(infile)) for infile in infiles]
     
-    # In case infiles is a list of files
+    # In case infiles is a list of files. Read as text, as paths are handled as strings, skipping blank lines.
     if len(infiles) == 1 and os.path.isfile(infiles[0]):
-        with open(infiles[0], 'rb') as infile:
-            infiles = [row.rstrip() for row in infile]
+        with open(infiles[0], 'r') as infile:
+            infiles = [row.rstrip() for row in infile if row.strip()]
+    
+    tile_tag = '_T%s'%tile
+    level_tag = '_MSIL%s_'%level
     
     # List to collate 
     infiles_reduced = []
@@ -627,26 +739,33 @@ def prepInfiles(infiles, level, tile = ''):
         
         # Remove trailing /, if present
         infile = infile.rstrip('/')
+        
+        # Split off the last two path components, without splitting the whole path
+        parent, _, name = infile.rpartition('/')
          
-        # Where infile is a directory:
-        infiles_reduced.extend(glob.glob('%s/*_MSIL%s_*/GRANULE/*'%(infile, level)))
+        # Where infile is a directory (expanding any wildcards):
+        for directory in (glob.glob(infile) if re.search(r'[*?[]', infile) else [infile or '/']):
+            infiles_reduced.extend(_listGranules(directory, level))
         
         # Where infile is a .SAFE file
-        if '_MSIL%s_'%level in infile.split('/')[-1]: infiles_reduced.extend(glob.glob('%s/GRANULE/*'%infile))
+        if level_tag in name: infiles_reduced.extend(glob.glob('%s/GRANULE/*'%infile))
         
         # Where infile is a specific granule 
-        if len(infile.split('/')) >1 and infile.split('/')[-2] == 'GRANULE': infiles_reduced.extend(glob.glob('%s'%infile))
-    
-    # Strip repeats (in case)
-    infiles_reduced = list(set(infiles_reduced))
+        if '/' in infile and parent.rpartition('/')[2] == 'GRANULE': infiles_reduced.extend(glob.glob('%s'%infile))
     
-    # Reduce input to infiles that match the tile (where specified)
-    infiles_reduced = [infile for infile in infiles_reduced if ('_T%s'%tile in infile.split('/')[-1])]
+    # In a single pass, strip repeats (in case) and reduce input to L1C or L2A infiles that match the tile (where specified)
+    infiles_seen = set()
+    infiles_out = []
     
-    # Reduce input files to only L1C or L2A files
-    infiles_reduced = [infile for infile in infiles_reduced if ('_MSIL%s_'%level in infile.split('/')[-3])]
+    for infile in infiles_reduced:
+        
+        if infile in infiles_seen: continue
+        infiles_seen.add(infile)
+        
+        path = infile.rsplit('/', 3)
+        if tile_tag in path[-1] and level_tag in path[-3]: infiles_out.append(infile)
     
-    return infiles_reduced
+    return infiles_out
 
 
 def _sortScenes(scenes, by = 'tile'):
@@ -662,25 +781,43 @@ def _sortScenes(scenes, by = 'tile'):
     
     assert by in ['tile', 'date'], "Sentinel-2 scenes can only be sorted by 'tile' or by 'date'."
     
-    scenes_out = []
-    
     scenes = np.array(scenes)
     
     dates = np.array([scene.datetime for scene in scenes])
     tiles = np.array([scene.tile for scene in scenes])
     
+    # Sort in a single pass, where the last key is the primary sort key
     if by == 'tile':
-        for tile in np.unique(tiles):
-            scenes_out.extend(scenes[tiles == tile][np.argsort(dates[tiles == tile])].tolist())
+        order = np.lexsort((dates, tiles))
     
     elif by == 'date':
-        for date in np.unique(dates):
-            scenes_out.extend(scenes[dates == date][np.argsort(tiles[dates == date])].tolist())
+        order = np.lexsort((tiles, dates))
+    
+    return scenes[order].tolist()
+
+
+def _loadScene(source_file, resolution = 20):
+    """
+    Load a single scene as a sen2mosaic.LoadScene() object, warning rather than failing where it can't be loaded.
+    
+    Args:
+        source_file: A Sentinel-2 granule.
+        resolution: Resolution to load, in metres.
+    Returns:
+        A sen2mosaic.LoadScene() object, or None where the scene couldn't be loaded.
+    """
+    
+    try:
+        return sen2mosaic.LoadScene(source_file, resolution = resolution)
     
-    return scenes_out
+    except Exception as e:
+        
+        print("WARNING: Error in loading scene %s with error '%s'. Continuing."%(source_file,str(e)))
+        
+        return None
 
 
-def loadSceneList(infiles, resolution = 20, md_dest = None, start = '20150101', end = datetime.datetime.today().strftime('%Y%m%d'), level = '2A', sort_by = None):
+def loadSceneList(infiles, resolution = 20, md_dest = None, start = '20150101', end = None, level = '2A', sort_by = None):
     """
     Function to load a list of infiles or all files in a directory as sen2moisac.LoadScene() objects.
     """
@@ -688,16 +825,31 @@ def loadSceneList(infiles, resolution = 20, md_dest = None, start = '20150101',
     # Prepare input string, or list of files
     source_files = prepInfiles(infiles, level)
     
+    # Loading a scene is mostly spent waiting on metadata reads from disk, so where there are many load them in threads
+    load = functools.partial(_loadScene, resolution = resolution)
+    
+    if len(source_files) < 8:
+        loaded = [load(source_file) for source_file in source_files]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = min(16, 2 * (os.cpu_count() or 1))) as executor:
+            loaded = list(executor.map(load, source_files))
+    
+    # Parse dates once, rather than for each scene
+    if end is None: end = datetime.datetime.today().strftime('%Y%m%d')
+    start_date = datetime.datetime.strptime(start, '%Y%m%d')
+    end_date = datetime.datetime.strptime(end, '%Y%m%d')
+    
+    # Coordinate transformations are shared between scenes, so test scenes in this thread only
     scenes = []
-    for source_file in source_files:
+    for source_file, scene in zip(source_files, loaded):
+        
+        if scene is None: continue
+        
         try:
             
-            # Load scene
-            scene = sen2mosaic.LoadScene(source_file, resolution = resolution)
-            
-            # Skip scene if conditions not met
+            # Skip scene if conditions not met, testing the date first as it doesn't require a coordinate transformation
+            if scene.testInsideDate(start = start_date, end = end_date) == False: continue
             if md_dest is not None and scene.testInsideTile(md_dest) == False: continue
-            if scene.testInsideDate(start = start, end = end) == False: continue
             
             scenes.append(scene)
         
@@ -1,6 +1,7 @@
 
 import copy
 import datetime
+import functools
 import glob
 import numpy as np
 import os
@@ -52,6 +53,9 @@ class Metadata(object):
         
         # Get projection
         self.proj = self.__getProjection()
+        
+        # Store projection as WKT, which is required each time the image is reprojected or written
+        self.wkt = self.proj.ExportToWkt()
                 
         # Calculate array size
         self.nrows = self.__getNRows()
@@ -114,6 +118,28 @@ class Metadata(object):
         return np.zeros((self.nrows, self.ncols), dtype = dtype)
 
 
+@functools.lru_cache(maxsize = None)
+def _getTransform(EPSG_source, EPSG_dest):
+    '''
+    Build a coordinate transformation between two EPSG codes. Transformations are cached, as most scenes share a handful of UTM zones.
+    
+    Args:
+        EPSG_source: EPSG code of the source coordinate reference system.
+        EPSG_dest: EPSG code of the destination coordinate reference system.
+    
+    Returns:
+        An osr.CoordinateTransformation object.
+    '''
+    
+    proj_source = osr.SpatialReference()
+    proj_source.ImportFromEPSG(EPSG_source)
+    
+    proj_dest = osr.SpatialReference()
+    proj_dest.ImportFromEPSG(EPSG_dest)
+    
+    return osr.CoordinateTransformation(proj_source, proj_dest)
+
+
 
 #########################################
 ### Class for loading Sentinel-2 data ###
@@ -373,8 +399,8 @@ class LoadScene(object):
             A numpy array of the SCL mask with modifications.
         """
         
-        # Make a copy of the original classification mask
-        mask_orig = mask.copy()
+        # Record the original extent of nodata, rather than copying the whole classification mask
+        nodata = mask == 0
         
         # Change cloud shadow to dark areas
         mask[mask == 3] = 2
@@ -383,10 +409,10 @@ class LoadScene(object):
         iterations = int(round(1800/float(self.resolution)))
         
         # Identify pixels proximal to any measure of cloud cover
-        cloud_dilated = scipy.ndimage.morphology.binary_dilation((np.logical_or(mask==8, mask==9)).astype(np.int), iterations = iterations)
+        cloud_dilated = scipy.ndimage.binary_dilation((mask == 8) | (mask == 9), iterations = iterations)
         
-        # Set these to dark features
-        mask[np.logical_and(np.logical_or(mask == 2, mask == 3), cloud_dilated)] = 3
+        # Set these to cloud shadows (all cloud shadows are now dark features)
+        mask[(mask == 2) & cloud_dilated] = 3
             
         if cloud_buffer > 0:
             
@@ -399,21 +425,21 @@ class LoadScene(object):
             for i in [3,8,9]:
                             
                 # Grow the area of each input class
-                mask_dilate = scipy.ndimage.morphology.binary_dilation((mask==i).astype(np.int), iterations = iterations)
+                mask_dilate = scipy.ndimage.binary_dilation(mask == i, iterations = iterations)
                 
                 # Set dilated area to the same value as input class (except for high probability cloud, set to medium)
-                mask_temp[mask_dilate] = i if i is not 9 else 8
+                mask_temp[mask_dilate] = i if i != 9 else 8
             
-            mask = mask_temp.copy()
+            mask = mask_temp
         
         # Erode outer 0.6 km of image tile (should retain overlap)
         iterations = int(round(600 / float(self.resolution)))
         
         # Grow the area of nodata pixels (everything that is equal to 0)
-        mask_erode = scipy.ndimage.morphology.binary_dilation((mask_orig == 0).astype(np.int), iterations=iterations)
+        mask_erode = scipy.ndimage.binary_dilation(nodata, iterations = iterations)
         
         # Set these eroded areas to 0
-        mask[mask_erode == True] = 0
+        mask[mask_erode] = 0
                     
         return mask
     
@@ -449,12 +475,15 @@ class LoadScene(object):
             A boolean (True/False) value.
         '''
         
-        # Set up function to translate coordinates from source to destination
-        tx = osr.CoordinateTransformation(self.metadata.proj, md_dest.proj)
+        # Get function to translate coordinates from source to destination
+        tx = _getTransform(self.metadata.EPSG_code, md_dest.EPSG_code)
         
-        # And translate the source coordinates
-        ulx, uly, z = tx.TransformPoint(self.metadata.ulx, self.metadata.uly)
-        lrx, lry, z = tx.TransformPoint(self.metadata.lrx, self.metadata.lry) 
+        # And translate all four source corners, as the source extent is rotated in a different projection
+        corners = tx.TransformPoints([(self.metadata.ulx, self.metadata.uly), (self.metadata.lrx, self.metadata.uly), (self.metadata.lrx, self.metadata.lry), (self.metadata.ulx, self.metadata.lry)])
+        
+        # Get the bounding box of the translated corners
+        xs, ys = [corner[0] for corner in corners], [corner[1] for corner in corners]
+        ulx, uly, lrx, lry = min(xs), max(ys), max(xs), min(ys)
         
         # Determine whether image is outside of tile
         out_of_tile =  ulx >= md_dest.lrx or \
@@ -464,20 +493,23 @@ class LoadScene(object):
         
         return out_of_tile == False
     
-    def testInsideDate(self, start = '20150101', end = datetime.datetime.today().strftime('%Y%m%d')):
+    def testInsideDate(self, start = '20150101', end = None):
         '''
         Function that uses metadata class to test whether a tile falls within the specified time range.
         
         Args:
-            start: Start date to process, in format 'YYYYMMDD' Defaults to start of Sentinel-2 era.
-            end: End date to process, in format 'YYYYMMDD' Defaults to today's date.
+            start: Start date to process, in format 'YYYYMMDD' Defaults to start of Sentinel-2 era. Also accepts a datetime.datetime, so that dates can be parsed once when testing many scenes.
+            end: End date to process, in format 'YYYYMMDD' Defaults to today's date. Also accepts a datetime.datetime.
             
         Returns:
             A boolean (True/False) value.
         '''
-                
-        start = datetime.datetime.strptime(start,'%Y%m%d')
-        end = datetime.datetime.strptime(end,'%Y%m%d')
+        
+        # Default to today's date, evaluated at call time rather than import time
+        if end is None: end = datetime.datetime.today().strftime('%Y%m%d')
+        
+        if not isinstance(start, datetime.datetime): start = datetime.datetime.strptime(start,'%Y%m%d')
+        if not isinstance(end, datetime.datetime): end = datetime.datetime.strptime(end,'%Y%m%d')
         
         if self.datetime > end:
             return False
@@ -506,7 +538,7 @@ class LoadScene(object):
             mask_nodata = self.getBand('B02', chunk = chunk) == 0
              
             # Initiate mask to pass all (4 = vegetation)
-            mask = np.zeros_like(mask_clouds, dtype = np.int) + 4
+            mask = np.zeros_like(mask_clouds, dtype = np.uint8) + 4
             mask[mask_clouds] = 9
             mask[mask_nodata] = 0
             
@@ -598,6 +630,11 @@ class LoadScene(object):
         # Re-cast chunk based on upcoming zoom factor
         if chunk is not None: chunk = np.round(np.array(chunk) / float(zoom),0).astype(np.int).tolist()
         
+        # Where a whole native resolution band is to be reprojected to another CRS, warp directly from the image (.jp2 format) so that GDAL streams it from disk block by block
+        if md is not None and chunk is None and zoom == 1 and md.EPSG_code != self.metadata.EPSG_code:
+            ds_dest = sen2mosaic.IO.createGdalDataset(md, dtype = 2)
+            return sen2mosaic.IO._reprojectImage(gdal.Open(image_path, 0), ds_dest, self.metadata, md)
+        
         # Load the image (.jp2 format)
         if chunk is None:
             data = gdal.Open(image_path, 0).ReadAsArray()
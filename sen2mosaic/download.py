@@ -8,6 +8,7 @@ import pandas
 import re
 import time
 import sentinelsat
+import shutil
 import zipfile
 
 import pdb
@@ -17,6 +18,58 @@ import pdb
 ### Functions for downloading Sentinel-2 data ###
 #################################################
 
+class _FastZipFile(zipfile.ZipFile):
+    """
+    A zipfile.ZipFile that skips CRC-32 verification when reading members. Intended only for archives with integrity already verified at download time (sentinelsat checks the MD5 sum of each product).
+    """
+    
+    def open(self, name, mode = 'r', pwd = None, **kwargs):
+        
+        ext_file = super(_FastZipFile, self).open(name, mode = mode, pwd = pwd, **kwargs)
+        
+        # ZipExtFile does not accumulate a CRC when there is no reference value
+        if mode == 'r': ext_file._expected_crc = None
+        
+        return ext_file
+
+
+def _extractMembers(zip_obj, output_dir, bands = None):
+    """
+    Extracts all members of an open .zip file. Equivalent to zipfile.ZipFile.extractall(), but creates each output directory once up front rather than testing for it per file.
+    
+    Args:
+        zip_obj: An open zipfile.ZipFile object.
+        output_dir: Directory to extract files to.
+        bands: Optionally specify a list of band names (e.g. ['B02', 'B03', 'B04', 'SCL']) to extract from IMG_DATA. Defaults to all bands.
+    """
+    
+    output_dir = os.path.abspath(output_dir)
+    
+    members = zip_obj.infolist()
+    
+    # Optionally skip image files for bands that aren't required. Metadata and QI files are always kept.
+    if bands is not None:
+        band_re = re.compile(r'_(?:%s)(?:_[0-9]{2}m)?\.jp2$'%'|'.join(bands))
+        members = [info for info in members if '/IMG_DATA/' not in info.filename or not info.filename.endswith('.jp2') or band_re.search(info.filename)]
+    
+    # Determine output locations, refusing any member that would be written outside of output_dir
+    targets = [os.path.normpath(os.path.join(output_dir, info.filename)) for info in members]
+    
+    for info, target in zip(members, targets):
+        if os.path.commonpath([output_dir, target]) != output_dir:
+            raise ValueError("Zip file member %s would be extracted outside of %s."%(info.filename, output_dir))
+    
+    # Create each unique directory once
+    for directory in set([target if info.is_dir() else os.path.dirname(target) for info, target in zip(members, targets)]):
+        os.makedirs(directory, exist_ok = True)
+    
+    # Stream each file to disk
+    for info, target in zip(members, targets):
+        if info.is_dir(): continue
+        with zip_obj.open(info) as source, open(target, 'wb') as dest:
+            shutil.copyfileobj(source, dest, 1024 * 1024)
+
+
 def _removeZip(zip_file):
     """
     Deletes Level 1C .zip file from disk.
@@ -60,26 +113,19 @@ def _get_filesize(products_df):
         A numpy array with file sizes in MB.
     """
     
-    size = [int(float(str(i).split(' ')[0])) for  i in products_df['size'].values]
-    suffix = [str(i).split(' ')[1].lower() for  i in products_df['size'].values]
+    # Split sizes (e.g. '1.02 GB') into a number and a unit in a single vectorised pass
+    extracted = products_df['size'].str.extract(r'(?P<num>[0-9.]+)\s+(?P<unit>[A-Za-z]+)')
     
-    size_mb = []
+    size = pandas.to_numeric(extracted['num']).astype(int)
     
-    for this_size, this_suffix in zip(size, suffix):
-        if this_suffix == 'kb' or this_suffix == 'kib':
-            size_mb.append(this_size * 0.001)
-        elif this_suffix == 'mb' or this_suffix == 'mib':
-            size_mb.append(this_size * 1.)
-        elif this_suffix == 'gb' or this_suffix == 'gib':
-            size_mb.append(this_size * 1000.)
-        else:
-            size_mb.append(this_size * 0.000001)
-
-    return np.array(size_mb)
+    # Convert units to MB, assuming bytes where a unit is not recognised
+    factors = extracted['unit'].str.lower().map({'kb': 0.001, 'kib': 0.001, 'mb': 1., 'mib': 1., 'gb': 1000., 'gib': 1000.}).fillna(0.000001)
+    
+    return (size * factors).to_numpy(dtype = np.float64)
 
 
-def search(tile, level = '1C', start = '20150523', end = datetime.datetime.today().strftime('%Y%m%d'),  maxcloud = 100, minsize = 25.):
-    """search(tile, start = '20161206', end = datetime.datetime.today().strftime('%Y%m%d'),  maxcloud = 100, minsize_mb = 25.)
+def search(tile, level = '1C', start = '20150523', end = None,  maxcloud = 100, minsize = 25.):
+    """search(tile, start = '20161206', end = None,  maxcloud = 100, minsize_mb = 25.)
     
     Searches for images from a single Sentinel-2 Granule that meet conditions of date range and cloud cover.
     
@@ -103,6 +149,9 @@ def search(tile, level = '1C', start = '20150523', end = datetime.datetime.today
     
     assert level in ['1C', '2A'], "Level must be '1C' or '2A'."
     
+    # Default to today's date, evaluated at call time rather than import time
+    if end is None: end = datetime.datetime.today().strftime('%Y%m%d')
+    
     # Set up start and end dates
     startdate = sentinelsat.format_query_date(start)
     enddate = sentinelsat.format_query_date(end)
@@ -173,8 +222,8 @@ def download(products_df, output_dir = os.getcwd()):
     return downloaded_files
 
 
-def decompress(zip_files, output_dir = os.getcwd(), remove = False):
-    '''decompress(zip_files, output_dir = os.getcwd(), remove = False
+def decompress(zip_files, output_dir = os.getcwd(), remove = False, verify_crc = False, bands = None):
+    '''decompress(zip_files, output_dir = os.getcwd(), remove = False, verify_crc = False, bands = None)
     
     Decompresses .zip files downloaded from SciHub, and optionally removes original .zip file.
     
@@ -182,6 +231,8 @@ def decompress(zip_files, output_dir = os.getcwd(), remove = False):
         zip_files: A list of .zip files to decompress.
         output_dir: Optionally specify an output directory. Defaults to the present working directory.
         remove: Boolean value, which when set to True deletes level 1C .zip files after decompression is complete. Defaults to False.
+        verify_crc: Set True to check the CRC-32 of each extracted file. Defaults to False, as downloads are already checksummed by sentinelsat.
+        bands: Optionally specify a list of bands to extract (e.g. ['B02', 'B03', 'B04', 'B08']), to save time and disk space where only a subset is required. Defaults to extracting all bands. Note that sen2mosaic.LoadScene() expects every band to be present, so this is only suitable where images are read directly. Can't be used with remove.
     '''
 
     if type(zip_files) == str: zip_files = [zip_files]
@@ -189,6 +240,9 @@ def decompress(zip_files, output_dir = os.getcwd(), remove = False):
     for zip_file in zip_files:
         assert zip_file[-4:] == '.zip', "Files to decompress must be .zip format."
     
+    # A partial .SAFE file is skipped as already extracted by later runs, so the .zip file is needed to recover the remaining bands
+    assert bands is None or remove == False, "The .zip file can't be removed where only a subset of bands is extracted."
+    
     # Decompress each zip file
     for zip_file in zip_files:
         
@@ -198,8 +252,18 @@ def decompress(zip_files, output_dir = os.getcwd(), remove = False):
         
         else:     
             print('Extracting %s'%zip_file)
-            with zipfile.ZipFile(zip_file) as obj:
-                obj.extractall(output_dir)
+            zip_class = zipfile.ZipFile if verify_crc else _FastZipFile
+            
+            with open(zip_file, 'rb') as f:
+                
+                # Archives are read sequentially, so ask the kernel for a larger readahead window
+                if hasattr(os, 'posix_fadvise'): os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                
+                with zip_class(f) as obj:
+                    _extractMembers(obj, output_dir, bands = bands)
+                
+                # Drop the archive from the page cache so it doesn't evict the extracted files
+                if hasattr(os, 'posix_fadvise'): os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
             
             # Delete zip file
             if remove: _removeZip(zip_file)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import concurrent.futures
 import datetime
 import glob
 import multiprocessing
@@ -7,7 +8,6 @@ import numpy as np
 import os
 from scipy import ndimage
 from scipy import interpolate
-import subprocess
 
 try:
     import xml.etree.cElementTree as ET
@@ -30,6 +30,10 @@ import pdb
 ### Internal functions ###
 ##########################
 
+# GeoTiff creation options shared by all outputs. Large output extents switch to BigTIFF where needed.
+_GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+
+
 def _nan_percentile(arr, quant):
     """
     Function to calculate a percentile along the first axis of a 3d array, much faster than np.nanpercentile.
@@ -62,18 +66,16 @@ def _nan_percentile(arr, quant):
         return np.take(arr, idx)
     
     # Valid (non NaN) observations along the first axis
-    valid_obs = np.sum(np.isfinite(arr), axis=0)
+    nan_mask = np.isnan(arr)
+    valid_obs = arr.shape[0] - np.count_nonzero(nan_mask, axis=0)
     
     # Replace NaN with maximum
     max_val = np.nanmax(arr)
-    arr[np.isnan(arr)] = max_val
+    arr[nan_mask] = max_val
     
-    # Sort - former NaNs will move to the end
-    arr = np.sort(arr, axis=0)
+    # Sort in place - former NaNs will move to the end
+    arr.sort(axis=0)
     
-    # Build output array
-    quant_arr = np.zeros(shape=(arr.shape[1], arr.shape[2]))
-
     # Desired position as well as floor and ceiling of it
     k_arr = (valid_obs - 1) * (quant / 100.0)
     f_arr = np.floor(k_arr).astype(np.int32)
@@ -81,15 +83,15 @@ def _nan_percentile(arr, quant):
     
     # Floor == Ceil
     fc_equal_k_mask = f_arr == c_arr
-
+    
     # Linear interpolation (like numpy percentile) takes the fractional part of desired position
-    floor_val = _zvalue_from_index(arr = arr, ind = f_arr) * (c_arr - k_arr)
-    ceil_val = _zvalue_from_index(arr = arr, ind = c_arr) * (k_arr - f_arr)
+    floor_val = _zvalue_from_index(arr = arr, ind = f_arr)
     
-    quant_arr = floor_val + ceil_val
-    quant_arr[fc_equal_k_mask] = _zvalue_from_index(arr = arr, ind = k_arr.astype(np.int32))[fc_equal_k_mask]  # if floor == ceiling take floor value
-
-    return np.round(quant_arr,0).astype(np.uint16)
+    quant_arr = floor_val * (c_arr - k_arr)
+    quant_arr += _zvalue_from_index(arr = arr, ind = c_arr) * (k_arr - f_arr)
+    np.copyto(quant_arr, floor_val, where = fc_equal_k_mask) # if floor == ceiling take floor value
+    
+    return np.round(quant_arr, 0, out = quant_arr).astype(np.uint16)
 
 
 def _makeBlocks(band, scene, step = 2000, percentile = 25., improve_mask = False, masked_vals = [], temp_dir = '/tmp'):
@@ -113,7 +115,6 @@ def _makeBlocks(band, scene, step = 2000, percentile = 25., improve_mask = False
         col_step = step if col + step <= scene.metadata.ncols else scene.metadata.ncols - col
         for row in range(0, scene.metadata.nrows, step):
             row_step = step if row + step <= scene.metadata.nrows else scene.metadata.nrows - row
-            if row_step ==0 or col_step ==0: pdb.set_trace()
             blocks.append([band, col, col_step, row, row_step, percentile, improve_mask, masked_vals, temp_dir])
      
     return blocks
@@ -132,28 +133,39 @@ def _doComposite(input_list):
     
     band, col, col_step, row, row_step, percentile, improve_mask, masked_vals, temp_dir = input_list
     
-    # Mask stack
+    # Mask stack. The band stack is only read where the mask is valid, so it needn't be initialised.
     m = np.zeros((len(scenes_tile), col_step, row_step), dtype = np.uint8)
-    b = np.zeros((len(scenes_tile), col_step, row_step), dtype = np.float32)
+    b = np.empty((len(scenes_tile), col_step, row_step), dtype = np.float32)
     
     for n, scene in enumerate(scenes_tile):
         
         m[n,:,:] = scene.getMask(improve = improve_mask, chunk = [row,col,row_step,col_step], temp_dir = temp_dir)
         
-        if m[n,:,:].sum() == 0: continue
+        if not m[n,:,:].any(): continue
         
         b[n,:,:] = scene.getBand(band, chunk = [row,col,row_step,col_step])
     
     # If nodata in the entire chunk, skip processing
-    if m.sum() == 0: return np.zeros_like(b[0,:,:]).astype(np.uint16), np.zeros_like(b[0,:,:]).astype(np.uint8)
+    if not m.any(): return np.zeros((col_step, row_step), dtype = np.uint16), np.zeros((col_step, row_step), dtype = np.uint8)
+    
+    # Track which observations are to be included for each pixel
+    valid = np.zeros_like(m, dtype = np.bool)
     
-    bm = np.ma.array(b, mask = np.ones_like(m,dtype=np.bool))
+    # Observation counts can't exceed the number of scenes, so use the smallest data type that fits
+    count_dtype = np.uint8 if len(scenes_tile) < 256 else np.uint16
     
     # Build output arrays
     nodata = np.ones_like(b[0,:,:], dtype = np.bool)
     slc = np.zeros_like(b[0,:,:], dtype = np.uint8)
-    slc_count = np.zeros_like(b[0,:,:], dtype = np.uint8)
-    slc_assigned = np.zeros_like(b[0,:,:], dtype = np.bool)
+    slc_count = np.zeros_like(b[0,:,:], dtype = count_dtype)
+    slc_unassigned = np.ones_like(b[0,:,:], dtype = np.bool)
+    
+    # Scratch arrays for comparisons, reused for each SLC value
+    better = np.empty_like(slc_unassigned)
+    selection = np.empty_like(slc_unassigned)
+    
+    # Scratch array for matching SLC values, reused for each value so that no copy of the mask stack is made at a wider data type
+    is_val = np.empty_like(m, dtype = np.bool)
     
     # Add pixels in order of desirability
     for n, vals in enumerate([[4,5,6], [2,7,11], [1,3,8,10], [9]]):
@@ -166,21 +178,31 @@ def _doComposite(input_list):
         # Skip if all vals are in masked_vals
         if len(vals) == 0: continue
         
-        bm[:,nodata] = np.ma.array(b, mask = np.isin(m, vals) == False)[:,nodata]
+        # Only pixels without an observation of a more desirable class are updated. Class membership is tested with a lookup table indexed by SLC value, which takes a single pass.
+        class_lut = np.zeros(256, dtype = np.bool)
+        class_lut[vals] = True
+        valid_class = class_lut[m[:,nodata]]
+        valid[:,nodata] = valid_class
         
         # Calculate modal SLC value
         for val in vals:
-            this_count = (m == val).sum(axis = 0)
-            slc[np.logical_and(this_count > slc_count, slc_assigned == False)] = val
-            slc_count[this_count > slc_count] = this_count[this_count > slc_count]
+            this_count = np.sum(np.equal(m, val, out = is_val), axis = 0, dtype = count_dtype)
+            np.greater(this_count, slc_count, out = better)
+            slc[np.logical_and(better, slc_unassigned, out = selection)] = val
+            np.copyto(slc_count, this_count, where = better)
         
-        slc_assigned[slc_count != 0] = True
+        slc_unassigned &= slc_count == 0
         
-        nodata = (bm.mask == False).sum(axis = 0) == 0
-            
-    bm = np.ma.filled(bm, np.nan)
+        # Pixels already containing data are unchanged, so only test those updated
+        nodata[nodata] = ~valid_class.any(axis = 0)
+        
+        # Once every pixel has data, less desirable classes can't contribute
+        if not nodata.any(): break
     
-    bm = _nan_percentile(bm, percentile)
+    # Exclude all other observations from the percentile calculation
+    b[~valid] = np.nan
+    
+    bm = _nan_percentile(b, percentile)
     
     # Set nodata to 0
     bm[nodata] = 0
@@ -192,7 +214,7 @@ def _doComposite(input_list):
 ### Functions to improve mosaic quality ###
 ###########################################
 
-def _histogramMatch(source, reference):
+def _histogramMatch(source, reference, source_valid = None, reference_valid = None):
     """       
     Adjust the values of a source array so that its histogram matches that of a reference array
     
@@ -200,79 +222,78 @@ def _histogramMatch(source, reference):
     
     Args:
         source: A numpy array of Sentinel-2 data
-        reference: A numpy array of Sentinel-2 data to match colours to
+        reference: A numpy array of Sentinel-2 data to match colours to. Both arrays must contain non-negative integers.
+        source_valid: Optionally specify a boolean array of source pixels to match. Other pixels are returned unchanged.
+        reference_valid: Optionally specify a boolean array of reference pixels to match to.
 
     Returns:
         target: A numpy array array with the same shape as source
     """
-        
-    orig_shape = source.shape
-    source = source.ravel()
-
-    if np.ma.is_masked(reference):
-        reference = reference.compressed()
-    else:
-        reference = reference.ravel()
-
-    # Get the set of unique pixel values
-    s_values, s_idx, s_counts = np.unique(source, return_inverse=True, return_counts=True)
     
-    # and those to match to
-    r_values, r_counts = np.unique(reference, return_counts=True)
-    s_size = source.size
-
-    if np.ma.is_masked(source):
-        mask_index = np.ma.where(s_values.mask)
-        s_size = np.ma.where(s_idx != mask_index[0])[0].size
-        s_values = s_values.compressed()
-        s_counts = np.delete(s_counts, mask_index)
-
+    source_values = np.ravel(source) if source_valid is None else source[source_valid]
+    reference_values = np.ravel(reference) if reference_valid is None else reference[reference_valid]
+    
+    # Sentinel-2 data are unsigned integers, so histograms can be built by counting each value directly rather than sorting
+    s_counts = np.bincount(source_values)
+    r_counts = np.bincount(reference_values)
+    
+    # Get the set of pixel values present in each image
+    s_values = np.flatnonzero(s_counts)
+    r_values = np.flatnonzero(r_counts)
+    
     # Calculate cumulative distribution
-    s_quantiles = np.cumsum(s_counts).astype(np.float64) / s_size
-    r_quantiles = np.cumsum(r_counts).astype(np.float64) / reference.size
-
-    # Find values in the reference corresponding to the quantiles in the source
-    interp_r_values = np.interp(s_quantiles, r_quantiles, r_values)
-
-    if np.ma.is_masked(source):
-        interp_r_values = np.insert(interp_r_values, mask_index[0], source.fill_value)
-
-    # using the inverted source indicies, pull out the interpolated pixel values
-    target = interp_r_values[s_idx]
-
-    if np.ma.is_masked(source):
-        target = np.ma.masked_where(s_idx == mask_index[0], target)
-        target.fill_value = source.fill_value
-
-    return target.reshape(orig_shape)
+    s_quantiles = np.cumsum(s_counts[s_values]).astype(np.float64) / source_values.size
+    r_quantiles = np.cumsum(r_counts[r_values]).astype(np.float64) / reference_values.size
+    
+    # Build a lookup table of values in the reference corresponding to the quantiles in the source
+    lut = np.zeros_like(s_counts, dtype = np.float64)
+    lut[s_values] = np.interp(s_quantiles, r_quantiles, r_values)
+    
+    if source_valid is None:
+        target = lut[source]
+    else:
+        target = source.astype(np.float64)
+        target[source_valid] = lut[source_values]
+    
+    return target
 
 
 def _colourBalance(image, reference, aggressive = True, verbose = False):
     '''
     Perform colour balancing between a new and reference image.
+    
+    Args:
+        image: A numpy array of Sentinel-2 data to be adjusted, with nodata set to 0.
+        reference: A numpy array of Sentinel-2 data to balance colours to, with nodata set to 0.
+        aggressive: Set False to only perform histogram matching for substantially overlapping images. Defaults to True.
+        verbose: Make script verbose (set True).
+    
+    Returns:
+        The colour balanced image.
     '''
     
     # Calculate overlap with other images
-    overlap = np.logical_and(image.mask == False, reference.mask == False)
+    image_valid = image != 0
+    overlap = image_valid & (reference != 0)
     
     # Calculate percent overlap between images
-    this_overlap = float(overlap.sum()) / (image.mask == False).sum()
+    this_overlap = float(np.count_nonzero(overlap)) / max(np.count_nonzero(image_valid), 1)
         
     if this_overlap > 0.02 and this_overlap <= 0.5 and aggressive:
         
         if verbose: print('        colour scaling')
                 
-        # Gain compensation (simple inter-scene correction)                    
-        this_intensity = np.mean(image[overlap])
-        ref_intensity = np.mean(reference[overlap])
+        # Gain compensation (simple inter-scene correction). Reduce over the overlap in place, rather than copying out the overlapping pixels.
+        this_intensity = np.mean(image, where = overlap)
+        ref_intensity = np.mean(reference, where = overlap)
         
-        image[image.mask == False] = np.round(image[image.mask == False] * (ref_intensity/this_intensity),0).astype(np.uint16)
+        image[image_valid] = np.round(image[image_valid] * (ref_intensity/this_intensity),0).astype(np.uint16)
         
     elif this_overlap > 0.5:
         
         if verbose: print('        colour matching')
         
-        image = _histogramMatch(image, reference)
+        image = _histogramMatch(image, reference, source_valid = image_valid, reference_valid = reference != 0)
         
     else:
         
@@ -285,7 +306,7 @@ def _colourBalance(image, reference, aggressive = True, verbose = False):
 ### Primary functions ###
 #########################
 
-def buildComposite(source_files, band, md_dest, resolution = 20, level = '2A', output_dir = os.getcwd(), output_name = 'mosaic', start = '20150101', end = datetime.datetime.today().strftime('%Y%m%d'), step = 2000, improve_mask = False, processes = 1, percentile = 25., colour_balance = False, masked_vals = 'auto', output_mask = True, temp_dir = '/tmp', verbose = False, resampling = 0):
+def buildComposite(source_files, band, md_dest, resolution = 20, level = '2A', output_dir = os.getcwd(), output_name = 'mosaic', start = '20150101', end = None, step = 2000, improve_mask = False, processes = 1, percentile = 25., colour_balance = False, masked_vals = 'auto', output_mask = True, temp_dir = '/tmp', verbose = False, resampling = 0, compress = 'LZW', scenes = None, return_mask = True):
     """
     
     Function to generate seamless mosaics from a list of Sentinel-2 level-1C/2A input files.
@@ -300,11 +321,18 @@ def buildComposite(source_files, band, md_dest, resolution = 20, level = '2A', o
         resolution: Resolution band 10, 20, or 60 m band to use. Defaults to 20.
         improve_mask: Set True to apply improvements Sentinel-2 cloud mask. Not generally recommended.
         processes: Number of processes to run similtaneously. Defaults to 1.
+        step: Size of square blocks (in pixels) in which each tile is composited. Must be an even number. Defaults to 2000.
         output_dir: Optionally specify an output directory.
         output_name: Optionally specify a string to precede output file names. Defaults to 'mosaic'.
         masked_vals: List of SLC mask values to not include in the final mosaic. Defaults to 'auto', which masks everything except [4,5,6]
         temp_dir: Directory to temporarily write L1C mask files. Defaults to /tmp
+        output_mask: Set True to output the SLC mask. Defaults to True.
         verbose: Make script verbose (set True).
+        compress: GeoTiff compression algorithm for output files, 'LZW' (default), 'DEFLATE' or 'ZSTD'. ZSTD is faster and produces smaller files, but requires GDAL >= 2.3 to read and write.
+        scenes: Optionally specify a list of scenes from sen2mosaic.IO.loadSceneList(), so that scenes can be loaded once and shared between bands. Where specified, source_files, start, end and level are not used to select scenes.
+        return_mask: Set False to skip building the SLC mask where output_mask is also False, returning None in its place. Defaults to True.
+    Returns:
+        The composite image and the SLC mask (or None, where neither output nor returned).
     """
     
     # Test input formatting
@@ -313,6 +341,8 @@ def buildComposite(source_files, band, md_dest, resolution = 20, level = '2A', o
     assert type(improve_mask) == bool, "improve_mask can only be set to True or False."
     assert level in ['1C', '2A'], "Sentinel-2 processing level must be either '1C' or '2A'."
     assert percentile >=0 and percentile <=100, "Percentile cannot be set less than 0% or greater than 100%."
+    assert compress in ['LZW', 'DEFLATE', 'ZSTD'], "Compression must be 'LZW', 'DEFLATE' or 'ZSTD'."
+    assert type(step) == int and step > 0 and step % 2 == 0, "Block size (step) must be a positive even integer, so that blocks align between 10 and 20 m images."
             
     # Set values to be masked
     if masked_vals == 'auto': masked_vals = [0,9]#[0,1,2,3,7,8,9,10,11]
@@ -327,8 +357,8 @@ def buildComposite(source_files, band, md_dest, resolution = 20, level = '2A', o
     for m in masked_vals:
         assert type(m) == int, "Masked values must all be integers."
 
-    # Load all Sentinel-2 input datasets
-    scenes = sen2mosaic.IO.loadSceneList(source_files, resolution = resolution, md_dest = md_dest, start = start, end = end, level = level, sort_by = 'date')
+    # Load all Sentinel-2 input datasets, unless already loaded
+    if scenes is None: scenes = sen2mosaic.IO.loadSceneList(source_files, resolution = resolution, md_dest = md_dest, start = start, end = end, level = level, sort_by = 'date')
     
     # It's only worth processing a tile if at least one input image is inside tile
     if len(scenes) == 0:
@@ -339,20 +369,29 @@ def buildComposite(source_files, band, md_dest, resolution = 20, level = '2A', o
         
     # Build blank output images    
     composite_out = md_dest.createBlankArray(dtype = np.uint16)
-    slc_out = md_dest.createBlankArray(dtype = np.uint8)
+    
+    # The mask is only built where it will be output or returned
+    build_mask = output_mask or return_mask
+    slc_out = md_dest.createBlankArray(dtype = np.uint8) if build_mask else None
         
     # Make list of scenes accessible
     global scenes_tile
     
+    # Group scenes by tile in a single pass
+    tiles, tile_index = np.unique([s.tile for s in scenes], return_inverse = True)
+    scenes = np.array(scenes)
+    
     # Process one Sentinel-2 tile at a time
-    for tile in np.unique([s.tile for s in scenes]):
+    for n_tile, tile in enumerate(tiles):
         
-        scenes_tile = np.array(scenes)[np.array([s.tile for s in scenes]) == tile]
+        scenes_tile = scenes[tile_index == n_tile]
         
         scene = scenes_tile[0]
                 
-        composite = np.zeros((scene.metadata.ncols, scene.metadata.nrows), dtype = np.uint16)
-        slc = np.zeros((scene.metadata.ncols, scene.metadata.nrows), dtype = np.uint8)
+        # Tiles are all the same size at a given resolution, so the per-tile output arrays are only built once. Every pixel is overwritten from the composited blocks.
+        if n_tile == 0 or composite.shape != (scene.metadata.ncols, scene.metadata.nrows):
+            composite = np.empty((scene.metadata.ncols, scene.metadata.nrows), dtype = np.uint16)
+            slc = np.empty((scene.metadata.ncols, scene.metadata.nrows), dtype = np.uint8)
         
         blocks = _makeBlocks(band, scene, step = step, percentile = percentile, improve_mask = improve_mask, masked_vals = masked_vals, temp_dir = temp_dir)        
         
@@ -371,26 +410,45 @@ def buildComposite(source_files, band, md_dest, resolution = 20, level = '2A', o
             composite[col:col+col_step,row:row+row_step] = composite_parts[n][0]
             slc[col:col+col_step,row:row+row_step] = composite_parts[n][1]
         
-        # Reproject to match output array
-        composite_rep = sen2mosaic.IO.reprojectBand(scene, composite, md_dest, dtype = 3, resampling = resampling)
-        slc_rep = sen2mosaic.IO.reprojectBand(scene, slc, md_dest, dtype = 1, resampling = 0)
+        # Where no block of the tile contained data, there is nothing to add to the mosaic
+        if not composite.any(): continue
+        
+        # Reproject to match output array. The mask is identical for every band, so only reproject it where it will be output or returned.
+        if build_mask and resampling == 0:
+            
+            # Where resampling matches, reproject composite and mask together so the transformation is only calculated once
+            rep = sen2mosaic.IO.reprojectBand(scene, np.dstack((composite, slc)), md_dest, dtype = 2, resampling = 0)
+            composite_rep, slc_rep = rep[:,:,0], rep[:,:,1]
+        
+        else:
+            composite_rep = sen2mosaic.IO.reprojectBand(scene, composite, md_dest, dtype = 2, resampling = resampling)
+            if build_mask: slc_rep = sen2mosaic.IO.reprojectBand(scene, slc, md_dest, dtype = 1, resampling = 0)
         
         # Do optional colour balancing
         if colour_balance:
-            composite_rep = _colourBalance(np.ma.array(composite_rep, mask = composite_rep == 0), np.ma.array(composite_out, mask = composite_out == 0), verbose = verbose)
-            composite_rep = composite_rep.filled(0)
+            composite_rep = _colourBalance(composite_rep, composite_out, verbose = verbose)
         
-        # Add pixels to the output mosaic
-        sel = composite_rep!=0
-        composite_out[sel] = composite_rep[sel]
-        slc_out[sel] = slc_rep[sel]
+        # Add pixels to the output mosaic, writing in place. Reprojected layers may be strided views of a stacked array, so avoid flat indexing. Colour matched images are floating point, and are truncated as with assignment.
+        sel = composite_rep != 0
+        np.copyto(composite_out, composite_rep, where = sel, casting = 'unsafe')
+        if build_mask: np.copyto(slc_out, slc_rep, where = sel, casting = 'unsafe')
     
-    # Output composite image
-    sen2mosaic.IO.createGdalDataset(md_dest, data_out = composite_out, filename = '%s/%s_R%sm_%s.tif'%(output_dir, output_name, str(scene.resolution), band), driver='GTiff', nodata = 0, options = ['COMPRESS=LZW'])        
+    # GeoTiff creation options, compressing blocks in parallel
+    options = _GTIFF_OPTIONS + ['COMPRESS=%s'%compress]
+    if compress == 'ZSTD': options.append('ZSTD_LEVEL=3')
     
-    # Output mask
-    if output_mask:
-        sen2mosaic.IO.createGdalDataset(md_dest, data_out = slc_out, filename = '%s/%s_R%sm_SLC.tif'%(output_dir, output_name, str(scene.resolution)), driver='GTiff', options = ['COMPRESS=LZW'])        
+    # GDAL releases the GIL while compressing and writing, so the composite and mask are written to disk at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 2) as executor:
+        
+        # Output composite image. Reflectance varies smoothly, so compresses better as differences between neighbouring pixels.
+        writes = [executor.submit(sen2mosaic.IO.createGdalDataset, md_dest, data_out = composite_out, filename = '%s/%s_R%sm_%s.tif'%(output_dir, output_name, str(scene.resolution), band), driver='GTiff', nodata = 0, options = options + ['PREDICTOR=2'])]
+        
+        # Output mask. SLC values are categorical, so are not differenced.
+        if output_mask:
+            writes.append(executor.submit(sen2mosaic.IO.createGdalDataset, md_dest, data_out = slc_out, filename = '%s/%s_R%sm_SLC.tif'%(output_dir, output_name, str(scene.resolution)), driver='GTiff', options = options + ['PREDICTOR=1']))
+        
+        # Raise any errors from writing
+        for write in writes: write.result()
     
     return composite_out, slc_out
         
@@ -413,10 +471,11 @@ def buildVRT(red_band, green_band, blue_band, output_path):
     if output_path[-4:] != '.vrt':
         output_path += '.vrt'
     
-    command = ['gdalbuildvrt', '-separate', '-overwrite']
-    command += [output_path, red_band, green_band, blue_band]
+    from osgeo import gdal
     
-    subprocess.call(command)
+    # Build in process rather than calling gdalbuildvrt. The file is written when the dataset is closed.
+    ds = gdal.BuildVRT(output_path, [red_band, green_band, blue_band], separate = True)
+    ds = None
 
 
 if __name__ == '__main__':
@@ -1,5 +1,5 @@
+import concurrent.futures
 import multiprocessing
-import queue
 import psutil
 import signal
 import subprocess
@@ -10,85 +10,61 @@ import subprocess
 
 ## Used in sen2mosaic and sen1mosaic preprocessing steps
 
-def _do_work(job_queue, partial_func, counter=None):
+def _runJob(job):
     """
-    Processes jobs from  the multiprocessing queue until all jobs are finished
-    Adapted from: https://github.com/ikreymer/cdx-index-client
+    Runs a single job in a worker process. The function to run is inherited from runWorkers() when the worker is forked, rather than being pickled, as it may hold GDAL objects.
     
     Args:
-        job_queue: multiprocessing.Queue() object
-        counter: multiprocessing.Value() object
+        job: An individual input for the function passed to runWorkers()
     """
-           
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    while not job_queue.empty():
-        try:
-            job = job_queue.get_nowait()
-            
-            partial_func(job)
-
-            num_done = 0
-            with counter.get_lock():
-                counter.value += 1
-                num_done = counter.value
-                
-        except queue.Empty:
-            pass
-
-        except KeyboardInterrupt:
-            break
-
-        except Exception:
-            if not job:
-                raise
+    
+    return _partial_func(job)
 
 
 def runWorkers(partial_func, n_processes, jobs):
     """
-    This script is a queuing system that respects KeyboardInterrupt.
-    Adapted from: https://github.com/ikreymer/cdx-index-client
-    Which in turn was adapted from: http://bryceboe.com/2012/02/14/python-multiprocessing-pool-and-keyboardinterrupt-revisited/
+    This script is a queuing system that respects KeyboardInterrupt. Jobs that fail are reported, but don't stop the remaining jobs.
     
     Args:
         partial_func: Function to be run (established with functools.partial())
         n_processes: Number of parallel processes
         jobs: List of individual inputs for partial_func (e.g. a list of Sentinel-2 images)
+    Returns:
+        A list of outputs from partial_func, in the order of jobs. Jobs that failed return None.
     """  
     
-    # Queue up all jobs
-    job_queue = multiprocessing.Queue()
-    counter = multiprocessing.Value('i', 0)
+    global _partial_func
+    _partial_func = partial_func
     
-    for job in jobs:
-        job_queue.put(job)
+    # Workers must be forked so that they inherit partial_func. KeyboardInterrupt is handled by this process alone.
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers = n_processes, mp_context = multiprocessing.get_context('fork'), initializer = signal.signal, initargs = (signal.SIGINT, signal.SIG_IGN))
     
-    workers = []
-    
-    for i in range(0, n_processes):
-        
-        tmp = multiprocessing.Process(target=_do_work, args=(job_queue, partial_func, counter))
-        tmp.daemon = True
-        tmp.start()
-        workers.append(tmp)
-
     try:
         
-        for worker in workers:
-            worker.join()
-            
+        futures = {executor.submit(_runJob, job): n for n, job in enumerate(jobs)}
+        
+        results = [None] * len(futures)
+        
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                print("WARNING: Job %s failed with error '%s'."%(str(jobs[futures[future]]), str(future.exception())))
+            else:
+                results[futures[future]] = future.result()
+        
+        executor.shutdown()
+        
     except KeyboardInterrupt:
-        for worker in workers:
-            print('Keyboard interrupt (ctrl-c) detected. Exiting all processes.')
-            # This is an impolite way to kill sen2cor, but it otherwise does not listen.
-            parent = psutil.Process(worker.pid)
-            children = parent.children(recursive=True)
-            parent.send_signal(signal.SIGKILL)
-            for process in children:
-                process.send_signal(signal.SIGKILL)
-            worker.terminate()
-            worker.join()
-            
+        print('Keyboard interrupt (ctrl-c) detected. Exiting all processes.')
+        
+        executor.shutdown(wait = False, cancel_futures = True)
+        
+        # This is an impolite way to kill sen2cor, but it otherwise does not listen.
+        for process in psutil.Process().children(recursive = True):
+            process.send_signal(signal.SIGKILL)
+        
         raise
+    
+    return results
 
 
 def runCommand(command, verbose = False):
@@ -113,18 +89,19 @@ def runCommand(command, verbose = False):
                 
         signal.signal(signal.SIGINT, handler)
         
-        p = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        # Merge stderr into stdout, so that a full stderr pipe can't stall the command while stdout is being read
+        p = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
         
         # Optionally print progress, skipping out with KeyboardInterrupt
         if verbose:
-            while True:
-                stdout_line = p.stdout.readline().decode('utf-8')
-                if stdout_line == '' and p.poll() is not None:
-                    break
-                if stdout_line:
-                    print(stdout_line)
+            lines = []
+            for stdout_line in iter(p.stdout.readline, b''):
+                lines.append(stdout_line.decode('utf-8'))
+                print(lines[-1].rstrip('\n'))
+            text = ''.join(lines)
         
-        text = p.communicate()[0]
+        else:
+            text = p.communicate()[0].decode('utf-8')
                 
         if p.wait():
             raise Exception('Command failed: %s'%' '.join(command))
@@ -133,5 +110,5 @@ def runCommand(command, verbose = False):
         # Reset handler
         signal.signal(signal.SIGINT, signal.SIG_DFL)
     
-    return text.decode('utf-8').split('/n')
+    return text.split('\n')
 
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import collections
+import functools
 import glob
 import numpy as np
 import os
@@ -10,6 +12,7 @@ import shutil
 import tempfile
 import time
 import xml.etree.ElementTree as ET
+import xml.sax.saxutils
 
 import sen2mosaic.multiprocess
 
@@ -19,6 +22,12 @@ import pdb
 ### Functions for preprocessing of Sentinel-2 L1C data to L2A ###
 #################################################################
 
+# Exemplar GIPP files, distributed with sen2mosaic
+_CFG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cfg')
+_DEFAULT_GIPP = os.path.join(_CFG_DIR, 'L2A_GIPP.xml')
+_DEFAULT_GIPP_v255 = os.path.join(_CFG_DIR, 'L2A_GIPP_v255.xml')
+
+
 def _which(program):
     '''
     Tests whether command line script exists. Mimics which in command line.
@@ -48,13 +57,40 @@ def _which(program):
 
 ### Primary functions
 
-def _setGipp(gipp, median_filter = 0, v255 = False):
+@functools.lru_cache(maxsize = None)
+def _loadGippTemplate(gipp, mtime, v255 = False):
+    """
+    Reads a L2A_GIPP.xml file and serialises it with placeholders for the options that are changed for each run. The result is cached, so each GIPP file is only parsed once.
+    
+    Args:
+        gipp: The path to a copy of the L2A_GIPP.xml file.
+        mtime: Modification time of the GIPP file, so that the cache is refreshed if it's edited.
+        v255: Set True for a GIPP file from sen2cor v2.5.5, which also specifies an output directory.
+    Returns:
+        The GIPP file contents as bytes, containing the placeholders {{TARGET_DIR}} and {{MEDIAN_FILTER}}.
+    """
+    
+    # Read GIPP file
+    tree = ET.ElementTree(file = gipp)
+    root = tree.getroot()
+    
+    # Change output directory (if old version)
+    if v255: root.find('Common_Section/Target_Directory').text = '{{TARGET_DIR}}'
+    
+    root.find('Scene_Classification/Filters/Median_Filter').text = '{{MEDIAN_FILTER}}'
+    
+    return ET.tostring(root)
+
+
+def _setGipp(gipp, output_dir = os.getcwd(), median_filter = 0, v255 = False):
     """
     Function that tweaks options in sen2cor's L2A_GIPP.xml file to specify an output directory.
     
     Args:
         gipp: The path to a copy of the L2A_GIPP.xml file.
+        output_dir: Output directory, only used by sen2cor v2.5.5.
         median_filter: Set 0-3 to perform smoothing operation on classified scene. Not currently used.
+        v255: Set True for a GIPP file from sen2cor v2.5.5.
     Returns:
         The directory location of a temporary .gipp file, for input to L2A_Process
     """
@@ -63,28 +99,24 @@ def _setGipp(gipp, median_filter = 0, v255 = False):
     assert gipp != None, "GIPP file must be specified if you're changing sen2cor options."
     assert os.path.isfile(gipp), "GIPP XML options file doesn't exist at the location %s."%gipp  
     assert median_filter in [0, 1, 2, 3], "median_filter can only be 0-3."
-       
-    # Read GIPP file
-    tree = ET.ElementTree(file = gipp)
-    root = tree.getroot()
     
-    # Change output directory (if old version)
-    if v255: root.find('Common_Section/Target_Directory').text = output_dir
-        
-    root.find('Scene_Classification/Filters/Median_Filter').text = str(median_filter)
+    # Fill in options in the parsed GIPP file. The output directory is escaped as it would be by ElementTree.
+    template = _loadGippTemplate(gipp, os.path.getmtime(gipp), v255 = v255)
+    gipp_text = template.replace(b'{{TARGET_DIR}}', xml.sax.saxutils.escape(output_dir).encode('ascii', 'xmlcharrefreplace'))
+    gipp_text = gipp_text.replace(b'{{MEDIAN_FILTER}}', str(median_filter).encode())
     
-    # Generate a temporary output file
-    temp_gipp = tempfile.mktemp(suffix='.xml')
-        
-    # Ovewrite old GIPP file with new options
-    tree.write(temp_gipp)
+    # Generate a temporary output file, and write new options to it
+    fd, temp_gipp = tempfile.mkstemp(suffix='.xml')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(gipp_text)
     
     return temp_gipp
 
 
+@functools.lru_cache(maxsize = 4096)
 def getL2AFilename(L1C_file, output_dir = os.getcwd(), SAFE = False):
     """
-    Determine the level 2A tile path name from an input file (level 1C) tile.
+    Determine the level 2A tile path name from an input file (level 1C) tile. Results are cached, as the same file is looked up when processing and again when testing for completion.
     
     Args:
         L1C_file: Input level 1C .SAFE file tile (e.g. '/PATH/TO/*.SAFE/GRANULE/*').
@@ -101,7 +133,7 @@ def getL2AFilename(L1C_file, output_dir = os.getcwd(), SAFE = False):
     outfile = re.sub(r"_N[0-9]{4}","_N????", outfile)
     
     # Replace _OPER_ with _USER_ for case of old file format (in final 2 cases)
-    outfile = outfile[::-1].replace('_OPER_'[::-1],'_USER_'[::-1],2)[::-1]
+    outfile = '_USER_'.join(outfile.rsplit('_OPER_', 2))
     
     # Replace processing date
     outfile = re.sub(r"_[0-9]{8}T[0-9]{6}.SAFE","_????????T??????.SAFE", outfile)
@@ -168,17 +200,14 @@ def processToL2A(granule, gipp = None, output_dir = os.getcwd(), resolution = 0,
     
     # Get location of exemplar gipp file for modification
     if gipp == None:
-        if product_format == 'SAFE_COMPACT':
-            gipp = '/'.join(os.path.abspath(__file__).split('/')[:-2] + ['cfg','L2A_GIPP.xml'])
-        else:
-            gipp = '/'.join(os.path.abspath(__file__).split('/')[:-2] + ['cfg','L2A_GIPP_v255.xml'])
+        gipp = _DEFAULT_GIPP if product_format == 'SAFE_COMPACT' else _DEFAULT_GIPP_v255
             
     # Base command, including GIPP file appropriately set up
     if product_format == 'SAFE_COMPACT':
-        temp_gipp = _setGipp(gipp, median_filter = 0, v255 = False)
+        temp_gipp = _setGipp(gipp, output_dir = output_dir, median_filter = 0, v255 = False)
         command = [sen2cor, '--GIP_L2A', temp_gipp]
     else:
-        temp_gipp = _setGipp(gipp, median_filter = 0, v255 = True)
+        temp_gipp = _setGipp(gipp, output_dir = output_dir, median_filter = 0, v255 = True)
         command = [sen2cor_255, '--GIP_L2A', temp_gipp]
     
     # Specify resolution
@@ -196,26 +225,23 @@ def processToL2A(granule, gipp = None, output_dir = os.getcwd(), resolution = 0,
     # print(command for user info
     if verbose: print(' '.join(command))
     
-    # Do the processing, and capture exceptions
+    # Do the processing, tidying up the temporary options file whether or not it succeeds
     try:
         output_text = sen2mosaic.multiprocess.runCommand(command, verbose = verbose)
-        t=1
-    except Exception as e:
-        # Tidy up temporary options file
+    finally:
         os.remove(temp_gipp)
-        raise
-    
-    # Tidy up temporary options file
-    os.remove(temp_gipp)
     
     # Get path of .SAFE file.
     outpath_SAFE = getL2AFilename(granule, output_dir = output_dir, SAFE = True)
         
-    # Occasionally sen2cor outputs a _null directory. This can cause problems, so should be removed.
-    bad_directories = glob.glob('%s/GRANULE/*_null/'%outpath_SAFE)
-    
-    if bad_directories:
-        [shutil.rmtree(bd) for bd in bad_directories]
+    # Occasionally sen2cor outputs a _null directory. This can cause problems, so should be removed. The .SAFE path contains wildcards, so is matched with glob, but its granules are listed directly.
+    for SAFE_dir in glob.glob(outpath_SAFE):
+        
+        if not os.path.isdir('%s/GRANULE'%SAFE_dir): continue
+        
+        for entry in os.scandir('%s/GRANULE'%SAFE_dir):
+            if entry.name.endswith('_null') and entry.is_dir(follow_symlinks = False):
+                shutil.rmtree(entry.path)
      
     return outpath
 
@@ -232,33 +258,26 @@ def testCompletion(L1C_file, output_dir = os.getcwd(), resolution = 0):
       
     L2A_file = getL2AFilename(L1C_file, output_dir = output_dir, SAFE = False)
     
+    expected_bands = {10: ['B02', 'B03', 'B04', 'B08', 'AOT', 'TCI', 'WVP'],
+                      20: ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'AOT', 'TCI', 'WVP', 'SCL'],
+                      60: ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'AOT', 'TCI', 'WVP', 'SCL']}
+    
     failure = False
     
-    # Test all expected 10 m files are present
-    if resolution == 0 or resolution == 10:
+    # Test all expected files are present at each resolution
+    for res in [10, 20, 60]:
         
-        for band in ['B02', 'B03', 'B04', 'B08', 'AOT', 'TCI', 'WVP']:
-            
-            if not len(glob.glob('%s/IMG_DATA/R10m/*_%s_10m.jp2'%(L2A_file,band))) == 1:
-                failure = True
-    
-    # Test all expected 20 m files are present
-    if resolution == 0 or resolution == 20:
+        if resolution != 0 and resolution != res: continue
         
-        for band in ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'AOT', 'TCI', 'WVP', 'SCL']:
-            
-            if not len(glob.glob('%s/IMG_DATA/R20m/*_%s_20m.jp2'%(L2A_file,band))) == 1:
-                
-                failure = True
-
-    # Test all expected 60 m files are present
-    if resolution == 0 or resolution == 60:
+        suffix = '_%sm.jp2'%str(res)
         
-        for band in ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'AOT', 'TCI', 'WVP', 'SCL']:
-            
-            if not len(glob.glob('%s/IMG_DATA/R60m/*_%s_60m.jp2'%(L2A_file,band))) == 1:
-                
-                failure = True
+        # List each image directory once, counting files by band (e.g. *_B02_10m.jp2), rather than searching for each band in turn
+        band_counts = collections.Counter()
+        for img_dir in glob.glob('%s/IMG_DATA/R%sm'%(L2A_file, str(res))):
+            band_counts.update(entry.name[:-len(suffix)].split('_')[-1] for entry in os.scandir(img_dir) if entry.name.endswith(suffix) and not entry.name.startswith('.'))
+        
+        if any(band_counts[band] != 1 for band in expected_bands[res]):
+            failure = True
     
     # At present we only report failure/success, can be extended to type of failure 
     return failure == False